@@ -5,11 +5,15 @@ Analizzatore dati CSV per Tank Analysis Tool
 """
 
 import csv
-from datetime import datetime
+import sys
+import threading
+from operator import itemgetter
 from collections import defaultdict
 
-from config import REGEX_PATTERNS
-from utils import parse_time, to_float, calculate_fA, sanitize_level, normalize_material, is_valid_value
+import numpy as np
+
+from config import REGEX_PATTERNS, ANALYSIS_CACHE_SIZE
+from utils import parse_time_column, to_float, calculate_kg_extracted_array, sanitize_level_array, normalize_material
 
 
 class TankAnalyzer:
@@ -25,8 +29,33 @@ class TankAnalyzer:
         self.avg_cols = []      # (idx, tank_key, family)
         self.level_idx = {}     # tank_key -> idx
         self.material_idx = {}  # tank_key -> idx
+        # Colonne già parsate: matrici [riga, slot] con uno slot per voce di avg_cols
+        # Le righe sono riordinate per timestamp (stabile, righe senza timestamp in coda):
+        # row_ids riporta all'indice originale, usato per l'ordine di lettura
+        self.row_ids = None     # indice riga originale per riga ordinata
+        self.T = None           # datetime64[s] per riga (NaT se mancante)
+        self.times = []         # datetime o None per riga
+        self.G = None           # gravity float64 (NaN se mancante)
+        self.V = None           # level float64 sanificato
+        self.M = None           # codice materiale int32 (indice in self.materials)
+        self.materials = []     # codice -> materiale normalizzato
+        self.tank_keys = None   # array [slot] -> tank_key
+        self.tanks = []         # codice tank -> tank_key (distinti, ordinati)
+        self.tank_codes = None  # array [slot] -> codice tank
+        self.families = None    # array [slot] -> famiglia (FST/BBT/RBT)
+        # Valori derivati, indipendenti dai filtri: calcolati una volta al caricamento
+        self.FA = None          # f(A)
+        self.KG = None          # Kg estratto
+        self.VALID = None       # maschera misure valide
+        self.days = []          # giorni disponibili "YYYY-MM-DD" ordinati
+        self._n_timed = 0       # numero di righe con timestamp (in testa)
+        self._day_codes = None  # indice in self.days per riga (-1 se senza timestamp)
         self.min_time = None
         self.max_time = None
+        # Aggregazioni di analyze per (periodo, filtri): i dati non cambiano dopo il caricamento
+        # Condivisa tra il thread di Tk e quello dei grafici: accessi sotto lock
+        self._analysis_cache = {}
+        self._cache_lock = threading.Lock()
         self._load_csv()
     
     def _load_csv(self):
@@ -42,6 +71,9 @@ class TankAnalyzer:
         self.rows = rows[1:]
         
         self._identify_columns()
+        self._build_columns()
+        self._sort_by_time()
+        self._compute_extract()
         self._calculate_time_range()
     
     def _identify_columns(self):
@@ -52,241 +84,358 @@ class TankAnalyzer:
                 self.time_idx = i
                 break
         
-        # Identifica colonne Average, Level, Material
-        patterns = REGEX_PATTERNS
+        # Identifica colonne Average, Level, Material con un solo match per intestazione
+        pattern = REGEX_PATTERNS['tank_column']
         
         for idx, col in enumerate(self.header):
             # Normalizza: rimuovi spazi extra
-            col_normalized = ' '.join(col.split())
+            m = pattern.match(' '.join(col.split()))
+            if not m:
+                continue
             
-            # Average Gravity/Plato
-            m = patterns['avg'].match(col_normalized)
-            if m:
-                family = m.group(1).upper()
-                num = m.group(2)
-                tank_key = f"{family}{num}"
+            family = m['fam'].upper()
+            tank_key = sys.intern(f"{family}{m['num']}")
+            kind = m['kind'].lower()
+            if kind.startswith('average'):
                 self.avg_cols.append((idx, tank_key, family))
+            elif kind == 'level':
+                self.level_idx[tank_key] = idx
+            else:
+                self.material_idx[tank_key] = idx
+    
+    def _build_columns(self):
+        """
+        Parsa una sola volta le colonne utilizzate (Time, Gravity, Level, Material):
+        le analisi successive leggono i valori già convertiti invece di riparsare le righe
+        """
+        rows = self.rows
+        columns = self._project_columns()
+        missing = [None] * len(rows)
+        ti = self.time_idx
+        if ti is None:
+            self.T = np.full(len(rows), np.datetime64('NaT'), dtype='datetime64[s]')
+        else:
+            self.T = parse_time_column(columns[ti])
+        # NaT -> None
+        self.times = self.T.astype(object).tolist()
+        
+        # Matrici in ordine Fortran: ogni colonna (slot) è contigua in memoria
+        shape = (len(rows), len(self.avg_cols))
+        self.G = np.full(shape, np.nan, dtype=np.float64, order='F')
+        self.V = np.full(shape, np.nan, dtype=np.float64, order='F')
+        self.M = np.zeros(shape, dtype=np.int32, order='F')
+        # Array di oggetti: tolist() restituisce le stesse stringhe internate, senza copie
+        self.tank_keys = np.array([tank_key for _, tank_key, _ in self.avg_cols], dtype=object)
+        tanks, self.tank_codes = np.unique(self.tank_keys, return_inverse=True)
+        self.tanks = tanks.tolist()
+        self.families = np.array([family for _, _, family in self.avg_cols], dtype=str)
+        mat_codes = {}  # materiale normalizzato (internato) -> codice
+        
+        for k, (idx, tank_key, family) in enumerate(self.avg_cols):
+            # None -> NaN
+            self.G[:, k] = np.array([to_float(v) for v in columns[idx]], dtype=np.float64)
             
-            # Level
-            m2 = patterns['level'].match(col_normalized)
-            if m2:
-                family = m2.group(1).upper()
-                num = m2.group(2)
-                self.level_idx[f"{family}{num}"] = idx
+            lvl = self.level_idx.get(tank_key)
+            self.V[:, k] = np.array([to_float(v) for v in columns.get(lvl, missing)], dtype=np.float64)
             
-            # Material
-            m3 = patterns['material'].match(col_normalized)
-            if m3:
-                family = m3.group(1).upper()
-                num = m3.group(2)
-                self.material_idx[f"{family}{num}"] = idx
+            raw = columns.get(self.material_idx.get(tank_key), missing)
+            # Normalizza solo i valori distinti della colonna (poche decine), poi indicizza
+            lut = {
+                v: mat_codes.setdefault(sys.intern(normalize_material(v)), len(mat_codes))
+                for v in dict.fromkeys(raw)
+            }
+            self.M[:, k] = [lut[v] for v in raw]
+        
+        self.materials = list(mat_codes)
+        
+        # Level mancante/NaN o negativo -> 0, su tutta la matrice in un colpo solo
+        self.V = sanitize_level_array(self.V)
+    
+    def _project_columns(self):
+        """
+        Estrae dalle righe solo le colonne usate (Time, Gravity, Level, Material)
+        con un unico itemgetter per riga; le righe corte sono completate con ''
+        
+        Returns:
+            dict: {indice colonna: lista valori}
+        """
+        needed = {idx for idx, _, _ in self.avg_cols}
+        needed.update(self.level_idx.values(), self.material_idx.values())
+        if self.time_idx is not None:
+            needed.add(self.time_idx)
+        needed = sorted(needed)
+        if not needed:
+            return {}
+        
+        width = needed[-1] + 1
+        get = itemgetter(*needed, needed[-1])  # almeno due indici: restituisce sempre una tupla
+        values = zip(*(get(r) if len(r) >= width else get(r + [''] * (width - len(r))) for r in self.rows))
+        columns = dict(zip(needed, map(list, values)))
+        # CSV senza righe di dati
+        for idx in needed:
+            columns.setdefault(idx, [])
+        return columns
+    
+    def _sort_by_time(self):
+        """
+        Riordina una volta le colonne per timestamp (ordinamento stabile, NaT in coda):
+        ogni giorno e ogni intervallo temporale diventano una fetta contigua di righe
+        """
+        order = np.argsort(self.T, kind='stable')
+        self.row_ids = order
+        self.T = self.T[order]
+        self.times = [self.times[i] for i in order.tolist()]
+        self.G = np.asfortranarray(self.G[order])
+        self.V = np.asfortranarray(self.V[order])
+        self.M = np.asfortranarray(self.M[order])
+        self._n_timed = int(np.count_nonzero(~np.isnat(self.T)))
+    
+    def _compute_extract(self):
+        """
+        Calcola f(A), Kg e maschera di validità di tutte le misure in un'unica passata:
+        non dipendono dai filtri, quindi le analisi si limitano a filtrare e ridurre
+        """
+        # Level già sanificato in _build_columns
+        self.KG, self.FA = calculate_kg_extracted_array(self.G, self.V)
+        # Gravity mancante/NaN -> f(A) NaN -> misura scartata
+        self.VALID = ~np.isnan(self.FA)
     
     def _calculate_time_range(self):
-        """Calcola il range temporale dei dati"""
-        if self.time_idx is None:
+        """Calcola il range temporale dei dati e la lista dei giorni disponibili"""
+        # Timestamp già formattati "YYYY-MM-DD HH:MM:SS" una sola volta per file ('' se assente)
+        self.time_strs = np.full(len(self.T), '', dtype='<U19')
+        self._day_codes = np.full(len(self.T), -1, dtype=np.int64)
+        if self._n_timed == 0:
             return
-        
-        for row in self.rows:
-            if self.time_idx < len(row):
-                dt = parse_time(row[self.time_idx])
-                if dt:
-                    if self.min_time is None or dt < self.min_time:
-                        self.min_time = dt
-                    if self.max_time is None or dt > self.max_time:
-                        self.max_time = dt
+        timed = self.T[:self._n_timed]
+        self.time_strs[:self._n_timed] = np.char.replace(np.datetime_as_string(timed, unit='s'), 'T', ' ')
+        self.min_time = timed[0].astype(object)
+        self.max_time = timed[-1].astype(object)
+        days, self._day_codes[:self._n_timed] = np.unique(timed.astype('datetime64[D]'), return_inverse=True)
+        self.days = days.astype(str).tolist()
     
     def analyze(self, t_from=None, t_to=None, include_fst=True, include_bbt=True, include_rbt=True):
         """
-        Analizza i dati e restituisce aggregazioni per tank, materiale e debug
+        Analizza i dati e restituisce aggregazioni per tank, materiale e debug.
+        Le aggregazioni sono memorizzate per (periodo, filtri); il debug (una tupla
+        per misura) è ricostruito a ogni chiamata per non trattenerlo in memoria
         
         Returns:
-            tuple: (tank_rows, material_rows, debug_data)
+            tuple: (tank_rows, material_rows, debug_data) dove
+                   debug_data = [(dt, dt_str, tank, materiale, gravity, level, f(A), kg)]
+                   con dt_str timestamp già formattato ('' se assente)
         """
-        by_tank = {}
-        by_material = {}
-        debug_data = []
-        
-        for row in self.rows:
-            # Filtro temporale
-            dt = self._get_row_timestamp(row)
-            if not self._passes_time_filter(dt, t_from, t_to):
-                continue
-            
-            # Processa ogni tank
-            for idx, tank_key, family in self.avg_cols:
-                if not self._passes_family_filter(family, include_fst, include_bbt, include_rbt):
-                    continue
-                
-                # Estrai dati
-                data = self._extract_tank_data(row, idx, tank_key)
-                if data is None:
-                    continue
-                
-                gravity, level, material, fa_value, kg_extracted = data
-                
-                # Aggiungi a debug
-                debug_data.append((dt, tank_key, material, gravity, level, fa_value, kg_extracted))
-                
-                # Aggrega per tank
-                self._aggregate_by_tank(by_tank, tank_key, gravity, level, material, fa_value, kg_extracted, dt)
-                
-                # Aggrega per materiale
-                self._aggregate_by_material(by_material, material, fa_value, kg_extracted)
+        measures = self._measures(t_from, t_to, include_fst, include_bbt, include_rbt)
         
-        # Ordina risultati
-        tank_rows = self._sort_tank_results(by_tank)
-        material_rows = self._sort_material_results(by_material)
-        debug_data.sort(key=lambda x: x[0] if x[0] else datetime.min)
+        key = (t_from, t_to, bool(include_fst), bool(include_bbt), bool(include_rbt))
+        with self._cache_lock:
+            aggregates = self._analysis_cache.get(key)
+        if aggregates is None:
+            # Calcolo fuori dal lock; lettura, scarto e inserimento restano atomici
+            aggregates = self._aggregate(measures)
+            with self._cache_lock:
+                if key not in self._analysis_cache and len(self._analysis_cache) >= ANALYSIS_CACHE_SIZE:
+                    # Scarta il risultato più vecchio
+                    del self._analysis_cache[next(iter(self._analysis_cache))]
+                self._analysis_cache[key] = aggregates
         
-        return tank_rows, material_rows, debug_data
+        tank_rows, material_rows = aggregates
+        return tank_rows, material_rows, self._debug_rows(*measures)
     
-    def analyze_all_days(self, include_fst=True, include_bbt=True, include_rbt=True):
+    def analyze_daily(self, t_from=None, t_to=None, include_fst=True, include_bbt=True, include_rbt=True):
         """
-        Analizza tutti i giorni disponibili per grafici temporali
+        Aggrega per giorno (solo le righe con timestamp), usato per i grafici temporali:
+        solo np.bincount sulle misure selezionate, senza debug né ultima misura per tank,
+        e senza memorizzare il risultato
         
         Returns:
             dict: {day_string: {'kg': total, 'by_material': {}, 'by_tank': {}}}
         """
-        if self.time_idx is None:
-            return {}
+        rows, _, tanks, codes, _, kg = self._measures(t_from, t_to, include_fst, include_bbt, include_rbt)
+        return self._aggregate_daily(rows, tanks, codes, kg)
+    
+    def _measures(self, t_from, t_to, include_fst, include_bbt, include_rbt):
+        """
+        Misure selezionate da periodo e filtri famiglia come array piatti, per colonna
+        
+        Returns:
+            tuple: (rows, slots, tanks, codes, fa, kg)
+        """
+        # Il filtro temporale è una fetta contigua di righe (ordinate per timestamp)
+        lo, hi = self._time_range(t_from, t_to)
+        sel = self._selection(slice(lo, hi), include_fst, include_bbt, include_rbt)
         
-        daily_data = defaultdict(lambda: {
-            'kg': 0.0,
-            'by_material': defaultdict(float),
-            'by_tank': defaultdict(float)
-        })
+        slots, rows = np.nonzero(sel.T)
+        rows += lo
+        return (rows, slots, self.tank_codes[slots], self.M[rows, slots],
+                self.FA[rows, slots], self.KG[rows, slots])
+    
+    def _aggregate(self, measures):
+        """
+        Aggregazioni memorizzabili (senza debug)
+        
+        Returns:
+            tuple: (tank_rows, material_rows)
+        """
+        rows, slots, tanks, codes, fa, kg = measures
+        by_tank = self._aggregate_by_tank(rows, slots, tanks, codes, fa, kg)
+        by_material = self._aggregate_by_material(codes, fa, kg)
+        
+        # Ordina risultati
+        return self._sort_tank_results(by_tank), self._sort_material_results(by_material)
+    
+    def _debug_rows(self, rows, slots, tanks, codes, fa, kg):
+        """Debug costruito per colonne, ordinato per timestamp (NaT per primo) e ordine di lettura riga/tank"""
+        order = np.lexsort((slots, self.row_ids[rows], self.T[rows].astype(np.int64)))
+        d_rows, d_slots = rows[order], slots[order]
+        return list(zip(
+            self.T[d_rows].astype(object).tolist(),
+            self.time_strs[d_rows].tolist(),
+            self.tank_keys[d_slots].tolist(),
+            np.array(self.materials, dtype=object)[codes[order]].tolist(),
+            self.G[d_rows, d_slots].tolist(),
+            self.V[d_rows, d_slots].tolist(),
+            fa[order].tolist(),
+            kg[order].tolist()
+        ))
+    
+    def daily_last_by_tank(self, include_fst=True, include_bbt=True, include_rbt=True):
+        """
+        Ultima misura valida di ogni giorno per ciascun tank (base dell'analisi variazioni)
         
-        for row in self.rows:
-            dt = self._get_row_timestamp(row)
-            if dt is None:
+        Returns:
+            dict: {tank_key: {day_string: (material, gravity, level, fa_value, kg_extracted)}}
+        """
+        last = defaultdict(dict)  # tank_key -> day -> ((timestamp, riga, slot), data)
+        sel = self._selection(slice(0, self._n_timed), include_fst, include_bbt, include_rbt)
+        
+        for k, tank_key in enumerate(self.tank_keys.tolist()):
+            rows = np.flatnonzero(sel[:, k])
+            if rows.size == 0:
                 continue
+            days = last[tank_key]
             
-            day_key = dt.date().strftime("%Y-%m-%d")
-            
-            for idx, tank_key, family in self.avg_cols:
-                if not self._passes_family_filter(family, include_fst, include_bbt, include_rbt):
-                    continue
-                
-                data = self._extract_tank_data(row, idx, tank_key)
-                if data is None:
-                    continue
-                
-                _, _, material, _, kg_extracted = data
-                
-                daily_data[day_key]['kg'] += kg_extracted
-                daily_data[day_key]['by_material'][material] += kg_extracted
-                daily_data[day_key]['by_tank'][tank_key] += kg_extracted
+            for r, i, d, code, gravity, level, fa_value, kg_extracted in zip(
+                    rows.tolist(), self.row_ids[rows].tolist(), self._day_codes[rows].tolist(),
+                    self.M[rows, k].tolist(), self.G[rows, k].tolist(),
+                    self.V[rows, k].tolist(), self.FA[rows, k].tolist(), self.KG[rows, k].tolist()):
+                dt = self.times[r]
+                day_key = self.days[d]
+                # A parità di timestamp vince l'ultima misura in ordine di lettura
+                order = (dt, i, k)
+                prev = days.get(day_key)
+                if prev is None or order > prev[0]:
+                    days[day_key] = (order, (self.materials[code], gravity, level, fa_value, kg_extracted))
         
-        return daily_data
+        return {
+            tank_key: {day_key: data for day_key, (_, data) in days.items()}
+            for tank_key, days in last.items()
+        }
     
     # ============= METODI HELPER PRIVATI =============
     
-    def _get_row_timestamp(self, row):
-        """Estrae il timestamp da una riga"""
-        if self.time_idx is None or self.time_idx >= len(row):
-            return None
-        return parse_time(row[self.time_idx])
-    
-    def _passes_time_filter(self, dt, t_from, t_to):
-        """Verifica se il timestamp passa il filtro temporale"""
-        if self.time_idx is not None and (t_from or t_to):
-            if dt is None:
-                return False
-            if t_from and dt < t_from:
-                return False
-            if t_to and dt > t_to:
-                return False
-        return True
+    def _time_range(self, t_from, t_to):
+        """
+        Fetta (lo, hi) di righe che passa il filtro temporale, trovata per bisezione
+        sulle righe ordinate (quelle senza timestamp passano solo senza filtro)
+        """
+        if self.time_idx is None or not (t_from or t_to):
+            return 0, len(self.T)
+        timed = self.T[:self._n_timed]
+        lo = int(np.searchsorted(timed, np.datetime64(t_from), side='left')) if t_from else 0
+        hi = int(np.searchsorted(timed, np.datetime64(t_to), side='right')) if t_to else self._n_timed
+        return lo, max(lo, hi)
     
-    def _passes_family_filter(self, family, include_fst, include_bbt, include_rbt):
-        """Verifica se la famiglia di tank passa il filtro"""
-        if family == 'FST' and not include_fst:
-            return False
-        if family == 'BBT' and not include_bbt:
-            return False
-        if family == 'RBT' and not include_rbt:
-            return False
-        return True
+    def _selection(self, row_slice, include_fst, include_bbt, include_rbt):
+        """Maschera [riga, slot] delle misure valide nella fetta di righe che passano il filtro famiglia"""
+        allowed = [family for family, included in (('FST', include_fst), ('BBT', include_bbt), ('RBT', include_rbt))
+                   if included]
+        slot_mask = np.isin(self.families, allowed)
+        return self.VALID[row_slice] & slot_mask[None, :]
     
-    def _extract_tank_data(self, row, idx, tank_key):
+    def _aggregate_by_tank(self, rows, slots, tanks, codes, fa, kg):
         """
-        Estrae e valida i dati di un tank da una riga
-        
-        Returns:
-            tuple or None: (gravity, level, material, fa_value, kg_extracted) or None se non valido
+        Aggrega per tank con np.bincount e sceglie l'ultima misura di ogni tank:
+        vince il timestamp maggiore (a parità, la prima in ordine di lettura);
+        le righe senza timestamp contano solo se nessuna misura ha un timestamp
+        (in quel caso vince l'ultima letta)
         """
-        if idx >= len(row):
-            return None
-        
-        # Gravity
-        gravity = to_float(row[idx])
-        if not is_valid_value(gravity):
-            return None
-        
-        # f(A)
-        fa_value = calculate_fA(gravity)
-        if not is_valid_value(fa_value):
-            return None
-        
-        # Level
-        level_idx = self.level_idx.get(tank_key)
-        level = to_float(row[level_idx]) if (level_idx is not None and level_idx < len(row)) else None
-        level = sanitize_level(level)
+        n_tanks = len(self.tanks)
+        sum_fA = np.bincount(tanks, weights=fa, minlength=n_tanks).tolist()
+        sum_kg = np.bincount(tanks, weights=kg, minlength=n_tanks).tolist()
+        count = np.bincount(tanks, minlength=n_tanks).tolist()
         
-        # Material
-        mat_idx = self.material_idx.get(tank_key)
-        material = row[mat_idx] if (mat_idx is not None and mat_idx < len(row)) else None
-        material = normalize_material(material)
+        # Ordina per (tank, priorità): l'ultima voce di ogni gruppo è la misura più recente
+        ts = self.T[rows]
+        timed = ~np.isnat(ts)
+        row_ids = self.row_ids[rows]
+        order = np.lexsort((
+            np.where(timed, -slots, slots),
+            np.where(timed, -row_ids, row_ids),
+            np.where(timed, ts.astype(np.int64), 0),
+            timed,
+            tanks
+        ))
+        sorted_tanks = tanks[order]
+        last = order[np.append(sorted_tanks[1:] != sorted_tanks[:-1], True)] if order.size else order
         
-        # Kg estratto
-        kg_extracted = fa_value * level
-        
-        return (gravity, level, material, fa_value, kg_extracted)
-    
-    def _aggregate_by_tank(self, by_tank, tank_key, gravity, level, material, fa_value, kg_extracted, timestamp):
-        """Aggrega dati per tank"""
-        if tank_key not in by_tank:
-            by_tank[tank_key] = {
-                'G_last': None,
-                'V_last': None,
-                'M_last': None,
-                't_last': None,
-                'sum_fA': 0.0,
-                'sum_kg': 0.0,
-                'count': 0
+        by_tank = {}
+        for t, i, k, code in zip(tanks[last].tolist(), rows[last].tolist(), slots[last].tolist(),
+                                 codes[last].tolist()):
+            by_tank[self.tanks[t]] = {
+                'G_last': self.G[i, k].item(),
+                'V_last': self.V[i, k].item(),
+                'M_last': self.materials[code],
+                'sum_fA': sum_fA[t],
+                'sum_kg': sum_kg[t],
+                'count': count[t]
             }
+        return by_tank
+    
+    def _aggregate_by_material(self, codes, fa, kg):
+        """Aggrega per materiale con np.bincount sui codici materiale"""
+        n_mat = len(self.materials)
+        sum_kg = np.bincount(codes, weights=kg, minlength=n_mat).tolist()
+        sum_fA = np.bincount(codes, weights=fa, minlength=n_mat).tolist()
+        count = np.bincount(codes, minlength=n_mat).tolist()
+        return {
+            self.materials[c]: {'sum_kg': sum_kg[c], 'sum_fA': sum_fA[c], 'count': count[c]}
+            for c in np.flatnonzero(count).tolist()
+        }
+    
+    def _aggregate_daily(self, rows, tanks, codes, kg):
+        """
+        Aggrega per giorno (solo righe con timestamp) con np.bincount su chiavi
+        combinate giorno*n + codice, per totale, materiale e tank
         
-        rec = by_tank[tank_key]
+        Returns:
+            dict: {day_string: {'kg': total, 'by_material': {}, 'by_tank': {}}}
+        """
+        day_codes = self._day_codes[rows]
+        timed = day_codes >= 0
+        day_codes, tanks, codes, kg = day_codes[timed], tanks[timed], codes[timed], kg[timed]
+        n_days, n_mat, n_tanks = len(self.days), len(self.materials), len(self.tanks)
         
-        # Aggiorna ultimi valori se timestamp più recente
-        if timestamp is not None:
-            if rec['t_last'] is None or timestamp > rec['t_last']:
-                rec['t_last'] = timestamp
-                rec['G_last'] = gravity
-                rec['V_last'] = level
-                rec['M_last'] = material
-        else:
-            rec['G_last'] = gravity
-            rec['V_last'] = level
-            rec['M_last'] = material
+        day_kg = np.bincount(day_codes, weights=kg, minlength=n_days).tolist()
+        day_count = np.bincount(day_codes, minlength=n_days)
+        mat_keys = day_codes * n_mat + codes
+        mat_kg = np.bincount(mat_keys, weights=kg, minlength=n_days * n_mat).reshape(n_days, n_mat)
+        mat_count = np.bincount(mat_keys, minlength=n_days * n_mat).reshape(n_days, n_mat)
+        tank_keys = day_codes * n_tanks + tanks
+        tank_kg = np.bincount(tank_keys, weights=kg, minlength=n_days * n_tanks).reshape(n_days, n_tanks)
+        tank_count = np.bincount(tank_keys, minlength=n_days * n_tanks).reshape(n_days, n_tanks)
         
-        rec['sum_fA'] += fa_value
-        rec['sum_kg'] += kg_extracted
-        rec['count'] += 1
-    
-    def _aggregate_by_material(self, by_material, material, fa_value, kg_extracted):
-        """Aggrega dati per materiale"""
-        if material not in by_material:
-            by_material[material] = {
-                'sum_kg': 0.0,
-                'sum_fA': 0.0,
-                'count': 0
+        # Conversione a liste Python in blocco (niente .item() per cella)
+        mat_kg, tank_kg = mat_kg.tolist(), tank_kg.tolist()
+        daily_data = {}
+        for d in np.flatnonzero(day_count).tolist():
+            day_mat_kg, day_tank_kg = mat_kg[d], tank_kg[d]
+            daily_data[self.days[d]] = {
+                'kg': day_kg[d],
+                'by_material': {self.materials[c]: day_mat_kg[c] for c in np.flatnonzero(mat_count[d]).tolist()},
+                'by_tank': {self.tanks[t]: day_tank_kg[t] for t in np.flatnonzero(tank_count[d]).tolist()}
             }
-        
-        rec = by_material[material]
-        rec['sum_kg'] += kg_extracted
-        rec['sum_fA'] += fa_value
-        rec['count'] += 1
+        return daily_data
     
     def _sort_tank_results(self, by_tank):
         """Converte e ordina risultati per tank"""
@@ -58,16 +58,21 @@ DATE_FORMATS = [
 import re
 
 REGEX_PATTERNS = {
-    # Accetta spazi opzionali tra tipo e numero, e spazi finali
-    'avg': re.compile(r"^(FST|BBT|RBT)\s*([0-9]+)\s*Average\s*(Plato|Gravity)\s*$", re.I),
-    'level': re.compile(r"^(FST|BBT|RBT)\s*([0-9]+)\s*Level\s*$", re.I),
-    'material': re.compile(r"^(FST|BBT|RBT)\s*([0-9]+)\s*Material\s*$", re.I),
+    # Colonne tank (Average Gravity/Plato, Level, Material) in un unico pattern:
+    # accetta spazi opzionali tra tipo e numero, e spazi finali
+    'tank_column': re.compile(
+        r"^(?P<fam>FST|BBT|RBT)\s*(?P<num>[0-9]+)\s*"
+        r"(?P<kind>Average\s*(?:Plato|Gravity)|Level|Material)\s*$",
+        re.I
+    ),
 }
 
 # ============= UI SETTINGS =============
 WINDOW_SIZE = "1280x760"
 WINDOW_MIN_SIZE = (1180, 700)
 SPLASH_DURATION = 2500  # millisecondi
+DEBUG_PAGE_SIZE = 5000  # righe mostrate per volta nella tab Debug
+LOAD_POLL_INTERVAL = 50  # millisecondi tra i controlli del caricamento in background
 
 # ============= COLORI =============
 COLORS = {
@@ -82,11 +87,15 @@ THRESHOLDS = {
     'significant_level_change': 10.0,  # hl - per evidenziare variazioni
 }
 
+# ============= CACHE ANALISI =============
+ANALYSIS_CACHE_SIZE = 64  # aggregazioni di analyze (senza debug) memorizzate per (filtri, periodo)
+
 # ============= EXPORT DEFAULTS =============
 EXPORT_FILENAMES = {
     'tank_csv': 'per_tank_gravity_volume_material_fa_kg.csv',
     'material_csv': 'per_material_somma_kg_fa.csv',
     'debug_csv': 'debug_dettaglio_calcoli.csv',
+    'debug_xlsx': 'debug_dettaglio_calcoli.xlsx',
     'variations_csv': 'variazioni_level_kg.csv',
     'raw_csv': 'dati_raw_completi.csv',
     'xlsx': 'report_tank_material_fa_kg.xlsx',
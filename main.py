@@ -7,19 +7,26 @@ Sviluppato da PA (ASS_ST)
 
 import os
 import csv
-from datetime import datetime
+import heapq
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
+from datetime import datetime
+from operator import itemgetter
+from xml.sax.saxutils import escape
 
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 
+import numpy as np
+
 # Import moduli custom
 from config import (
     APP_TITLE, APP_VERSION, APP_AUTHOR, APP_EMAIL, APP_DEPT,
-    WINDOW_SIZE, WINDOW_MIN_SIZE, SPLASH_DURATION,
+    WINDOW_SIZE, WINDOW_MIN_SIZE, SPLASH_DURATION, DEBUG_PAGE_SIZE, LOAD_POLL_INTERVAL,
     COLORS, THRESHOLDS, EXPORT_FILENAMES, FA_FORMULA
 )
-from utils import fmt_it, parse_time
+from utils import fmt_it, fmt_it_column, format_column, round_column
 from analyzer import TankAnalyzer
 
 # Import opzionali
@@ -43,6 +50,18 @@ except Exception:
 class TankAnalysisApp(tk.Tk):
     """Applicazione principale per l'analisi dei tank"""
     
+    # Testi nota finestra totale (indicizzati per flag "escludi Material=0")
+    _NOTE_TEXTS = {True: "(Material=0 escluso)", False: "(Material=0 incluso)"}
+    
+    # Intestazione export variazioni (CSV e foglio XLSX)
+    _VARIATION_HEADER = ['Data','Tank','Materiale','Level_Prec_hl','Level_Corr_hl','Delta_Level_hl',
+                         'Gravity_Prec','Gravity_Corr','Kg_Prec','Kg_Corr','Delta_Kg']
+    
+    # Tag colore righe variazioni (tuple condivise, nessuna allocazione per riga)
+    _TAG_DECREASE = ("decrease",)
+    _TAG_INCREASE = ("increase",)
+    _TAG_EMPTY = ()
+    
     def __init__(self):
         super().__init__()
         self.title(APP_TITLE)
@@ -53,12 +72,20 @@ class TankAnalysisApp(tk.Tk):
         self.analyzer = None
         self.current_file = None
         self.days_list = []
+        self._day_to_idx = {}   # giorno -> indice in days_list
         self.sel_day = tk.StringVar(value="")
         
+        # Caricamento CSV e dati dei grafici in background (un lavoro alla volta)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._load_future = None
+        self._charts_future = None
+        
         # Cache risultati
         self._cache_tank = []
         self._cache_mat = []
         self._cache_debug = []
+        self._debug_total = 0.0
+        self._debug_shown = 0   # righe debug già inserite nella tabella
         
         # Variabili UI
         self.var_exclude_mat0 = tk.BooleanVar(value=False)
@@ -69,6 +96,7 @@ class TankAnalysisApp(tk.Tk):
         
         # Windows
         self._tot_win = None
+        self._note_text = None
         
         # Grafici
         self.chart_figures = []
@@ -77,8 +105,11 @@ class TankAnalysisApp(tk.Tk):
         self.show_splash()
         self._build_ui()
         
-        # Inizializza cache variazioni
+        # Cache variazioni (_variations_key resta None finché non vengono caricate)
         self._cache_variations = []
+        self._variations_by_tank = {}
+        self._variation_days = []
+        self._variations_key = None
     
     # ==================== SPLASH SCREEN ====================
     
@@ -136,9 +167,12 @@ class TankAnalysisApp(tk.Tk):
         top = ttk.Frame(self)
         top.pack(fill=tk.X, padx=10, pady=10)
         
-        ttk.Button(top, text="Apri CSV...", command=self.on_open).pack(side=tk.LEFT)
+        self.btn_open = ttk.Button(top, text="Apri CSV...", command=self.on_open)
+        self.btn_open.pack(side=tk.LEFT)
         self.lbl_file = ttk.Label(top, text="Nessun file caricato", foreground=COLORS['info'])
         self.lbl_file.pack(side=tk.LEFT, padx=10)
+        # Visibile solo durante il caricamento
+        self.pb_load = ttk.Progressbar(top, mode='indeterminate', length=150)
     
     def _build_filters(self):
         """Filtri FST/BBT/RBT"""
@@ -189,12 +223,10 @@ class TankAnalysisApp(tk.Tk):
         ttk.Button(actions, text="Esporta per Tank (CSV)", command=self.on_export_tank_csv).pack(side=tk.LEFT)
         ttk.Button(actions, text="Esporta per Materiale (CSV)", command=self.on_export_mat_csv).pack(side=tk.LEFT, padx=(10,0))
         ttk.Button(actions, text="Esporta Debug (CSV)", command=self.on_export_debug_csv).pack(side=tk.LEFT, padx=(10,0))
+        ttk.Button(actions, text="Esporta Debug (XLSX)", command=self.on_export_debug_xlsx).pack(side=tk.LEFT, padx=(10,0))
         ttk.Button(actions, text="Esporta Variazioni (CSV)", command=self.on_export_variations_csv).pack(side=tk.LEFT, padx=(10,0))
         
-        btnx = ttk.Button(actions, text="Esporta report (XLSX)", command=self.on_export_xlsx)
-        if not HAS_OPENPYXL:
-            btnx.state(["disabled"])
-        btnx.pack(side=tk.LEFT, padx=(10,0))
+        ttk.Button(actions, text="Esporta report (XLSX)", command=self.on_export_xlsx).pack(side=tk.LEFT, padx=(10,0))
     
     def _build_footer(self):
         """Footer con credits"""
@@ -302,8 +334,12 @@ class TankAnalysisApp(tk.Tk):
         self.tv_debug.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         vsb_d.pack(side=tk.LEFT, fill=tk.Y)
         
-        self.lbl_debug_total = ttk.Label(tab, text="Totale Kg estratto (debug): -", font=("Segoe UI", 10, "bold"))
-        self.lbl_debug_total.pack(fill=tk.X, padx=10, pady=(5,10))
+        bottom = ttk.Frame(tab)
+        bottom.pack(fill=tk.X, padx=10, pady=(5,10))
+        self.lbl_debug_total = ttk.Label(bottom, text="Totale Kg estratto (debug): -", font=("Segoe UI", 10, "bold"))
+        self.lbl_debug_total.pack(side=tk.LEFT)
+        self.btn_debug_more = ttk.Button(bottom, text="Mostra altre", command=self._show_more_debug, state=tk.DISABLED)
+        self.btn_debug_more.pack(side=tk.RIGHT)
     
     # ==================== TAB: GRAFICI ====================
     
@@ -329,7 +365,8 @@ class TankAnalysisApp(tk.Tk):
         
         btn_frame = ttk.Frame(tab)
         btn_frame.pack(fill=tk.X, padx=10, pady=10)
-        ttk.Button(btn_frame, text="Genera Grafici", command=self.on_generate_charts).pack(side=tk.LEFT)
+        self.btn_charts = ttk.Button(btn_frame, text="Genera Grafici", command=self.on_generate_charts)
+        self.btn_charts.pack(side=tk.LEFT)
         ttk.Label(btn_frame, text="(analizza tutti i giorni disponibili)", foreground=COLORS['info']).pack(side=tk.LEFT, padx=10)
         ttk.Button(btn_frame, text="Esporta Grafici (PDF)", command=self.on_export_charts_pdf).pack(side=tk.LEFT, padx=(20,0))
         
@@ -484,12 +521,31 @@ class TankAnalysisApp(tk.Tk):
         if not path:
             return
         
+        # Lettura e parsing fuori dal thread di Tk: la GUI resta reattiva
+        self.btn_open.config(state=tk.DISABLED)
+        self.lbl_file.config(text=f"Caricamento {os.path.basename(path)}...")
+        self.pb_load.pack(side=tk.LEFT)
+        self.pb_load.start()
+        self._load_future = self._executor.submit(TankAnalyzer, path)
+        self.after(LOAD_POLL_INTERVAL, self._poll_load, path)
+    
+    def _poll_load(self, path):
+        """Controlla il caricamento in background e, a fine lettura, popola la GUI"""
+        if not self._load_future.done():
+            self.after(LOAD_POLL_INTERVAL, self._poll_load, path)
+            return
+        
+        self.pb_load.stop()
+        self.pb_load.pack_forget()
+        self.btn_open.config(state=tk.NORMAL)
         try:
-            self.analyzer = TankAnalyzer(path)
+            analyzer = self._load_future.result()
         except Exception as e:
+            self.lbl_file.config(text=os.path.basename(self.current_file) if self.current_file else "Nessun file caricato")
             messagebox.showerror("Errore", str(e))
             return
         
+        self.analyzer = analyzer
         self.current_file = path
         self.lbl_file.config(text=os.path.basename(path))
         self.populate_days()
@@ -499,21 +555,14 @@ class TankAnalysisApp(tk.Tk):
     def populate_days(self):
         """Popola lista giorni"""
         self.days_list = []
+        self._day_to_idx = {}
         if not self.analyzer or not self.analyzer.rows or self.analyzer.time_idx is None:
             self.cb_day['values'] = []
             return
         
-        seen = set()
-        for r in self.analyzer.rows:
-            if self.analyzer.time_idx < len(r):
-                dt = parse_time(r[self.analyzer.time_idx])
-                if dt:
-                    dstr = dt.date().strftime("%Y-%m-%d")
-                    if dstr not in seen:
-                        seen.add(dstr)
-                        self.days_list.append(dstr)
-        
-        self.days_list.sort()
+        # Giorni già estratti (e ordinati) dall'analyzer al caricamento
+        self.days_list = list(self.analyzer.days)
+        self._day_to_idx = {d: i for i, d in enumerate(self.days_list)}
         self.cb_day['values'] = self.days_list
         if self.days_list:
             self.sel_day.set(self.days_list[0])
@@ -541,13 +590,7 @@ class TankAnalysisApp(tk.Tk):
     
     def _current_day_index(self):
         """Indice giorno corrente"""
-        if not self.days_list:
-            return -1
-        day = self.sel_day.get().strip()
-        try:
-            return self.days_list.index(day)
-        except ValueError:
-            return -1
+        return self._day_to_idx.get(self.sel_day.get().strip(), -1)
     
     def on_apply(self):
         """Applica analisi"""
@@ -585,16 +628,13 @@ class TankAnalysisApp(tk.Tk):
     def _populate_summary_tables(self):
         """Popola tabelle riepilogo"""
         # Materiali
-        for r in self.tv_mat.get_children():
-            self.tv_mat.delete(r)
-        for m, kg, fa, n in self._cache_mat:
-            self.tv_mat.insert("", tk.END, values=(m, fmt_it(kg, 3), fmt_it(fa), n))
+        self._clear_tree(self.tv_mat)
+        self._fill_tree(self.tv_mat, [(m, fmt_it(kg, 3), fmt_it(fa), n) for m, kg, fa, n in self._cache_mat])
         
         # Tank
-        for r in self.tv.get_children():
-            self.tv.delete(r)
-        for tank, mat, g_last, v_last, sum_fa, kg_ext, n in self._cache_tank:
-            self.tv.insert("", tk.END, values=(
+        self._clear_tree(self.tv)
+        self._fill_tree(self.tv, [
+            (
                 tank,
                 mat if mat else '',
                 fmt_it(g_last, 2) if g_last is not None else "",
@@ -602,26 +642,62 @@ class TankAnalysisApp(tk.Tk):
                 fmt_it(sum_fa),
                 fmt_it(kg_ext, 3),
                 n
-            ))
+            )
+            for tank, mat, g_last, v_last, sum_fa, kg_ext, n in self._cache_tank
+        ])
+    
+    def _clear_tree(self, tv):
+        """Svuota la tabella con un'unica chiamata Tcl"""
+        children = tv.get_children()
+        if children:
+            tv.delete(*children)
+    
+    def _fill_tree(self, tv, rows, tags=None, append=False):
+        """
+        Inserisce righe già formattate nella tabella con il ridisegno delle colonne sospeso.
+        Su tabella appena svuotata inserisce a ritroso all'indice 0: in Tk l'inserimento
+        in coda scorre tutti i fratelli, quello in testa no
+        """
+        if tags is None:
+            tags = [()] * len(rows)
+        insert = tv.insert
+        tv.configure(displaycolumns=())
+        if append:
+            for values, tag in zip(rows, tags):
+                insert("", tk.END, values=values, tags=tag)
+        else:
+            for values, tag in zip(reversed(rows), reversed(tags)):
+                insert("", 0, values=values, tags=tag)
+        tv.configure(displaycolumns="#all")
     
     def _populate_debug_table(self):
-        """Popola tabella debug"""
-        for r in self.tv_debug.get_children():
-            self.tv_debug.delete(r)
-        
-        debug_total = 0.0
-        for dt, tank, mat, g, v, fa, kg in self._cache_debug:
-            self.tv_debug.insert("", tk.END, values=(
-                dt.strftime("%Y-%m-%d %H:%M:%S") if dt else "",
-                tank, mat,
-                fmt_it(g, 2) if g is not None else "",
-                fmt_it(v, 2) if v is not None else "",
-                fmt_it(fa, 6) if fa is not None else "",
-                fmt_it(kg, 3)
+        """Popola tabella debug (solo la prima pagina: le altre con 'Mostra altre')"""
+        self._clear_tree(self.tv_debug)
+        
+        self._debug_total = sum(row[7] for row in self._cache_debug)
+        self._debug_shown = 0
+        self._show_more_debug()
+    
+    def _show_more_debug(self):
+        """Aggiunge alla tabella debug la pagina successiva di righe"""
+        page = self._cache_debug[self._debug_shown:self._debug_shown + DEBUG_PAGE_SIZE]
+        
+        # Valori preformattati per colonna, poi inseriti senza ridisegnare le colonne
+        if page:
+            _, dt_strs, tanks, mats, gs, vs, fas, kgs = zip(*page)
+            values = list(zip(
+                dt_strs, tanks, mats,
+                fmt_it_column(gs, 2), fmt_it_column(vs, 2), fmt_it_column(fas, 6), fmt_it_column(kgs, 3)
             ))
-            debug_total += kg
+            self._fill_tree(self.tv_debug, values, append=self._debug_shown > 0)
+        self._debug_shown += len(page)
         
-        self.lbl_debug_total.config(text=f"Totale Kg estratto (debug): {fmt_it(debug_total, 3)} | Righe: {len(self._cache_debug)}")
+        total = len(self._cache_debug)
+        shown = f" (mostrate {self._debug_shown})" if self._debug_shown < total else ""
+        self.lbl_debug_total.config(
+            text=f"Totale Kg estratto (debug): {fmt_it(self._debug_total, 3)} | Righe: {total}{shown}"
+        )
+        self.btn_debug_more.config(state=tk.NORMAL if self._debug_shown < total else tk.DISABLED)
     
     def _parse_date(self, s):
         """Parse data YYYY-MM-DD"""
@@ -629,6 +705,9 @@ class TankAnalysisApp(tk.Tk):
         if not s:
             return None
         try:
+            # Percorso veloce per la forma fissa dei giorni in lista (YYYY-MM-DD)
+            if len(s) == 10 and s[4] == s[7] == "-" and s[:4].isdigit() and s[5:7].isdigit() and s[8:].isdigit():
+                return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]))
             return datetime.strptime(s, "%Y-%m-%d")
         except Exception:
             return None
@@ -644,87 +723,56 @@ class TankAnalysisApp(tk.Tk):
         # Mostra stato filtri
         print(f"[DEBUG] Filtri attivi: FST={self.b_fst.get()}, BBT={self.b_bbt.get()}, RBT={self.b_rbt.get()}")
         
-        # Analizza tutti i giorni disponibili
-        print("[DEBUG] Caricamento variazioni giornaliere...")
+        variations, sorted_days = self._compute_variations()
         
-        # Import necessari
-        from utils import to_float, calculate_fA, sanitize_level, normalize_material, is_valid_value
+        if not variations:
+            messagebox.showinfo("Info", "Nessuna variazione trovata. Verifica che ci siano almeno 2 giorni consecutivi con dati.")
+        else:
+            messagebox.showinfo("Successo", f"Caricate {len(variations)} variazioni giornaliere!\n\n"
+                              f"Giorni analizzati: {len(sorted_days)}\n"
+                              f"Confronti giorno-giorno: {len(sorted_days)-1}")
         
-        # Raggruppa tutti i dati per giorno e tank
-        daily_by_tank = defaultdict(lambda: defaultdict(list))
+        self.update_variations_table()
+    
+    def _compute_variations(self):
+        """
+        Calcola le variazioni giornaliere per tank, memorizzate per file e filtri famiglia:
+        tabella ed export riusano il risultato finché file e filtri non cambiano
+        
+        Returns:
+            tuple: (variazioni, giorni ordinati)
+        """
+        key = (self.analyzer, self.b_fst.get(), self.b_bbt.get(), self.b_rbt.get())
+        if key == self._variations_key:
+            return self._cache_variations, self._variation_days
         
-        for row in self.analyzer.rows:
-            # Ottieni timestamp
-            if self.analyzer.time_idx is None or self.analyzer.time_idx >= len(row):
-                continue
-            dt = parse_time(row[self.analyzer.time_idx])
-            if dt is None:
-                continue
-            
-            day_key = dt.date().strftime("%Y-%m-%d")
-            
-            for idx, tank_key, family in self.analyzer.avg_cols:
-                # Filtro famiglia
-                if family == 'FST' and not self.b_fst.get():
-                    continue
-                if family == 'BBT' and not self.b_bbt.get():
-                    continue
-                if family == 'RBT' and not self.b_rbt.get():
-                    continue
-                
-                # DEBUG: mostra cosa viene processato
-                # print(f"[DEBUG] Processando {tank_key} (famiglia: {family})")
-                
-                if idx >= len(row):
-                    continue
-                
-                # Estrai gravity
-                gravity = to_float(row[idx])
-                if not is_valid_value(gravity):
-                    continue
-                
-                fa_value = calculate_fA(gravity)
-                if not is_valid_value(fa_value):
-                    continue
-                
-                # Level
-                level_idx = self.analyzer.level_idx.get(tank_key)
-                level = to_float(row[level_idx]) if (level_idx is not None and level_idx < len(row)) else None
-                level = sanitize_level(level)
-                
-                # Material
-                mat_idx = self.analyzer.material_idx.get(tank_key)
-                material = row[mat_idx] if (mat_idx is not None and mat_idx < len(row)) else None
-                material = normalize_material(material)
-                
-                kg_extracted = fa_value * level
-                
-                daily_by_tank[tank_key][day_key].append((dt, material, gravity, level, fa_value, kg_extracted))
+        # Analizza tutti i giorni disponibili
+        print("[DEBUG] Caricamento variazioni giornaliere...")
         
-        print(f"[DEBUG] Tank trovati: {len(daily_by_tank)}")
+        # Ultima misurazione di ogni giorno per tank (colonne già parsate dall'analyzer)
+        tank_daily_last = self.analyzer.daily_last_by_tank(
+            include_fst=key[1],
+            include_bbt=key[2],
+            include_rbt=key[3]
+        )
         
-        # Per ogni tank, prendi l'ultima misurazione di ogni giorno
-        tank_daily_last = {}
-        all_days = set()
+        print(f"[DEBUG] Tank trovati: {len(tank_daily_last)}")
         
-        for tank, days_data in daily_by_tank.items():
-            tank_daily_last[tank] = {}
-            for day, measurements in days_data.items():
-                all_days.add(day)
-                # Ordina per timestamp e prendi l'ultimo
-                measurements.sort(key=lambda x: x[0])
-                last = measurements[-1]
-                _, material, gravity, level, fa_value, kg_extracted = last
-                tank_daily_last[tank][day] = (material, gravity, level, fa_value, kg_extracted)
+        all_days = set()
+        for days_data in tank_daily_last.values():
+            all_days.update(days_data.keys())
         
         # Ordina i giorni
         sorted_days = sorted(all_days)
         print(f"[DEBUG] Giorni trovati: {len(sorted_days)}")
         
         # Calcola variazioni giorno per giorno
-        self._cache_variations = []
+        variations = []
+        # Variazioni raggruppate per tank (ordine tank e giorni), per il filtro della tabella
+        by_tank = {}
         
         for tank in sorted(tank_daily_last.keys()):
+            start = len(variations)
             for i in range(1, len(sorted_days)):
                 prev_day = sorted_days[i-1]
                 curr_day = sorted_days[i]
@@ -738,74 +786,61 @@ class TankAnalysisApp(tk.Tk):
                 delta_level = v_curr - v_prev if (v_curr is not None and v_prev is not None) else None
                 delta_kg = kg_curr - kg_prev
                 
-                self._cache_variations.append((
+                variations.append((
                     curr_day, tank, mat_curr, 
                     v_prev, v_curr, delta_level,
                     g_prev, g_curr,
                     kg_prev, kg_curr, delta_kg
                 ))
+            if len(variations) > start:
+                by_tank[tank] = variations[start:]
         
-        print(f"[DEBUG] Variazioni calcolate: {len(self._cache_variations)}")
+        print(f"[DEBUG] Variazioni calcolate: {len(variations)}")
         
-        if not self._cache_variations:
-            messagebox.showinfo("Info", "Nessuna variazione trovata. Verifica che ci siano almeno 2 giorni consecutivi con dati.")
-        else:
-            messagebox.showinfo("Successo", f"Caricate {len(self._cache_variations)} variazioni giornaliere!\n\n"
-                              f"Giorni analizzati: {len(sorted_days)}\n"
-                              f"Confronti giorno-giorno: {len(sorted_days)-1}")
+        self._cache_variations = variations
+        self._variations_by_tank = by_tank
+        self._variation_days = sorted_days
+        self._variations_key = key
         
-        self.update_variations_table()
+        # Lista tank del filtro aggiornata solo quando cambiano le variazioni (già ordinati)
+        self.cb_filter_tank['values'] = ["Tutti"] + list(by_tank)
+        return variations, sorted_days
     
     def update_variations_table(self):
         """Aggiorna tabella variazioni con i dati calcolati"""
         # Pulisci tabella
-        for r in self.tv_variations.get_children():
-            self.tv_variations.delete(r)
+        self._clear_tree(self.tv_variations)
         
-        if not hasattr(self, '_cache_variations') or not self._cache_variations:
+        # Ricalcolate solo se file o filtri sono cambiati dal caricamento
+        variations = self._compute_variations()[0] if self._variations_key is not None else []
+        if not variations:
             self.lbl_var_summary.config(text="Nessuna variazione caricata. Clicca 'Carica Variazioni'.")
             return
         
-        # Aggiorna lista tank disponibili
-        all_tanks = sorted(set(v[1] for v in self._cache_variations))
-        self.cb_filter_tank['values'] = ["Tutti"] + all_tanks
-        
-        # Filtra per tank selezionato
+        # Filtra per tank selezionato (gruppi già pronti, nessuna scansione)
         filter_tank = self.var_filter_tank.get()
         if filter_tank != "Tutti":
-            variations_to_show = [v for v in self._cache_variations if v[1] == filter_tank]
+            variations_to_show = self._variations_by_tank.get(filter_tank, [])
         else:
-            variations_to_show = self._cache_variations
+            variations_to_show = variations
         
-        # Statistiche
-        total_delta_level = 0.0
-        total_delta_kg = 0.0
-        max_increase_level = 0.0
-        max_decrease_level = 0.0
-        max_increase_kg = 0.0
-        max_decrease_kg = 0.0
+        rows = []
+        tags = []
+        limit = THRESHOLDS['significant_level_change']
+        tag_decrease, tag_increase, tag_empty = self._TAG_DECREASE, self._TAG_INCREASE, self._TAG_EMPTY
         
         for var in variations_to_show:
             curr_day, tank, mat_curr, v_prev, v_curr, delta_level, g_prev, g_curr, kg_prev, kg_curr, delta_kg = var
             
-            if delta_level is not None:
-                total_delta_level += delta_level
-                max_increase_level = max(max_increase_level, delta_level)
-                max_decrease_level = min(max_decrease_level, delta_level)
-            
-            total_delta_kg += delta_kg
-            max_increase_kg = max(max_increase_kg, delta_kg)
-            max_decrease_kg = min(max_decrease_kg, delta_kg)
-            
             # Tag per colore
-            tag = ""
+            tag = tag_empty
             if delta_level is not None:
-                if delta_level < -THRESHOLDS['significant_level_change']:
-                    tag = "decrease"
-                elif delta_level > THRESHOLDS['significant_level_change']:
-                    tag = "increase"
+                if delta_level < -limit:
+                    tag = tag_decrease
+                elif delta_level > limit:
+                    tag = tag_increase
             
-            self.tv_variations.insert("", tk.END, values=(
+            rows.append((
                 curr_day, tank, mat_curr,
                 fmt_it(v_prev, 2) if v_prev is not None else "",
                 fmt_it(v_curr, 2) if v_curr is not None else "",
@@ -813,7 +848,21 @@ class TankAnalysisApp(tk.Tk):
                 fmt_it(g_prev, 2) if g_prev is not None else "",
                 fmt_it(g_curr, 2) if g_curr is not None else "",
                 fmt_it(kg_prev, 3), fmt_it(kg_curr, 3), fmt_it(delta_kg, 3)
-            ), tags=(tag,))
+            ))
+            tags.append(tag)
+        
+        self._fill_tree(self.tv_variations, rows, tags)
+        
+        # Statistiche con riduzioni NumPy sulle colonne delta: None -> NaN, ignorato;
+        # massimo aumento e calo partono da 0
+        delta_levels = np.array([var[5] for var in variations_to_show], dtype=float)
+        delta_kgs = np.array([var[10] for var in variations_to_show], dtype=float)
+        total_delta_level = float(np.nansum(delta_levels))
+        total_delta_kg = float(np.nansum(delta_kgs))
+        max_increase_level = float(np.fmax.reduce(delta_levels, initial=0.0))
+        max_decrease_level = float(np.fmin.reduce(delta_levels, initial=0.0))
+        max_increase_kg = float(np.fmax.reduce(delta_kgs, initial=0.0))
+        max_decrease_kg = float(np.fmin.reduce(delta_kgs, initial=0.0))
         
         num_variations = len(variations_to_show)
         
@@ -840,8 +889,7 @@ class TankAnalysisApp(tk.Tk):
         if not self.analyzer:
             return
         
-        for item in self.tv_raw.get_children():
-            self.tv_raw.delete(item)
+        self._clear_tree(self.tv_raw)
         
         self.tv_raw['columns'] = self.analyzer.header
         
@@ -867,16 +915,41 @@ class TankAnalysisApp(tk.Tk):
         if not self.analyzer or not HAS_MATPLOTLIB:
             return
         
-        for widget in self.charts_frame.winfo_children():
-            widget.destroy()
-        
-        self.chart_figures = []
-        
-        daily_data = self.analyzer.analyze_all_days(
+        # Aggregazione giornaliera (solo np.bincount, niente debug) fuori dal thread di Tk:
+        # la GUI resta reattiva
+        self.btn_charts.config(state=tk.DISABLED)
+        self._charts_future = self._executor.submit(
+            self.analyzer.analyze_daily,
             include_fst=self.b_fst.get(),
             include_bbt=self.b_bbt.get(),
             include_rbt=self.b_rbt.get()
         )
+        self.after(LOAD_POLL_INTERVAL, self._poll_charts, self.analyzer)
+    
+    def _poll_charts(self, analyzer):
+        """Controlla l'aggregazione in background e, a calcolo finito, disegna i grafici"""
+        if not self._charts_future.done():
+            self.after(LOAD_POLL_INTERVAL, self._poll_charts, analyzer)
+            return
+        
+        self.btn_charts.config(state=tk.NORMAL)
+        try:
+            daily_data = self._charts_future.result()
+        except Exception as e:
+            messagebox.showerror("Errore", str(e))
+            return
+        
+        # Nel frattempo è stato aperto un altro file: risultato non più valido
+        if analyzer is not self.analyzer:
+            return
+        self._build_charts(daily_data)
+    
+    def _build_charts(self, daily_data):
+        """Disegna i grafici dai dati giornalieri già aggregati"""
+        for widget in self.charts_frame.winfo_children():
+            widget.destroy()
+        
+        self.chart_figures = []
         
         if not daily_data:
             ttk.Label(self.charts_frame, text="Nessun dato disponibile per i grafici").pack(pady=20)
@@ -901,16 +974,13 @@ class TankAnalysisApp(tk.Tk):
         canvas1.draw()
         canvas1.get_tk_widget().pack(fill=tk.BOTH, expand=True, pady=5)
         
-        # Grafico 2: Per materiale (top 5)
-        all_materials = set()
+        # Grafico 2: Per materiale (top 5), totali in un'unica passata sui giorni
+        material_totals = defaultdict(float)
         for d in days:
-            all_materials.update(daily_data[d]['by_material'].keys())
+            for mat, kg in daily_data[d]['by_material'].items():
+                material_totals[mat] += kg
         
-        material_totals = {}
-        for mat in all_materials:
-            material_totals[mat] = sum(daily_data[d]['by_material'].get(mat, 0) for d in days)
-        
-        top_materials = sorted(material_totals.items(), key=lambda x: -x[1])[:5]
+        top_materials = heapq.nlargest(5, material_totals.items(), key=itemgetter(1))
         
         if top_materials:
             fig2 = Figure(figsize=(12, 4), dpi=80)
@@ -933,16 +1003,13 @@ class TankAnalysisApp(tk.Tk):
             canvas2.draw()
             canvas2.get_tk_widget().pack(fill=tk.BOTH, expand=True, pady=5)
         
-        # Grafico 3: Per tank (top 5)
-        all_tanks = set()
+        # Grafico 3: Per tank (top 5), totali in un'unica passata sui giorni
+        tank_totals = defaultdict(float)
         for d in days:
-            all_tanks.update(daily_data[d]['by_tank'].keys())
-        
-        tank_totals = {}
-        for tank in all_tanks:
-            tank_totals[tank] = sum(daily_data[d]['by_tank'].get(tank, 0) for d in days)
+            for tank, kg in daily_data[d]['by_tank'].items():
+                tank_totals[tank] += kg
         
-        top_tanks = sorted(tank_totals.items(), key=lambda x: -x[1])[:5]
+        top_tanks = heapq.nlargest(5, tank_totals.items(), key=itemgetter(1))
         
         if top_tanks:
             fig3 = Figure(figsize=(12, 4), dpi=80)
@@ -1020,12 +1087,13 @@ class TankAnalysisApp(tk.Tk):
     
     # ==================== TOTALE CANTINA ====================
     
-    def compute_totals(self):
-        """Calcola totali cantina"""
+    def compute_totals(self, excl0=None):
+        """Calcola totali cantina (excl0: flag già letto dal chiamante, altrimenti letto dalla UI)"""
         if not self._cache_mat:
             return 0.0, 0.0, 0
         
-        excl0 = self.var_exclude_mat0.get()
+        if excl0 is None:
+            excl0 = self.var_exclude_mat0.get()
         tot_kg = tot_fa = tot_n = 0
         
         for m, kg, fa, n in self._cache_mat:
@@ -1056,6 +1124,7 @@ class TankAnalysisApp(tk.Tk):
         self.lbl_tot_fa = ttk.Label(frm, text="Totale f(A): -")
         self.lbl_tot_n = ttk.Label(frm, text="Misure conteggiate: -")
         self.lbl_note = ttk.Label(frm, text="", foreground=COLORS['info'])
+        self._note_text = None
         
         self.lbl_tot_kg.pack(anchor=tk.W)
         self.lbl_tot_fa.pack(anchor=tk.W, pady=(4,0))
@@ -1073,13 +1142,18 @@ class TankAnalysisApp(tk.Tk):
         if not (self._tot_win and tk.Toplevel.winfo_exists(self._tot_win)):
             return
         
-        kg, fa, n = self.compute_totals()
+        # Una sola lettura della variabile Tk per refresh
+        excl0 = self.var_exclude_mat0.get()
+        kg, fa, n = self.compute_totals(excl0)
         self.lbl_tot_kg.config(text=f"Totale Kg estratto: {fmt_it(kg, 3)}")
         self.lbl_tot_fa.config(text=f"Totale f(A): {fmt_it(fa)}")
         self.lbl_tot_n.config(text=f"Misure conteggiate: {n}")
         
-        note = "(Material=0 escluso)" if self.var_exclude_mat0.get() else "(Material=0 incluso)"
-        self.lbl_note.config(text=note)
+        # Riconfigura la nota solo se il testo cambia
+        note = self._NOTE_TEXTS[excl0]
+        if note != self._note_text:
+            self.lbl_note.config(text=note)
+            self._note_text = note
     
     # ==================== EXPORT ====================
     
@@ -1098,16 +1172,7 @@ class TankAnalysisApp(tk.Tk):
             return
         
         try:
-            with open(path, 'w', encoding='utf-8', newline='') as f:
-                w = csv.writer(f)
-                w.writerow(['Tank','Materiale','Gravity_ultimo','Volume_ultimo','Somma_f(A)','Kg_estratto','Misure'])
-                for tank, mat, g_last, v_last, sum_fa, kg_ext, n in self._cache_tank:
-                    w.writerow([
-                        tank, mat or '',
-                        f"{g_last:.2f}" if g_last is not None else "",
-                        f"{v_last:.2f}" if v_last is not None else "",
-                        f"{sum_fa:.6f}", f"{kg_ext:.3f}", n
-                    ])
+            self._write_csv(path, self._tank_sheet())
             messagebox.showinfo("Esportato", f"File salvato in:\n{path}")
         except Exception as e:
             messagebox.showerror("Errore", str(e))
@@ -1127,11 +1192,7 @@ class TankAnalysisApp(tk.Tk):
             return
         
         try:
-            with open(path, 'w', encoding='utf-8', newline='') as f:
-                w = csv.writer(f)
-                w.writerow(['Materiale','Kg_estratto','Somma_f(A)','Misure'])
-                for m, kg, fa, n in self._cache_mat:
-                    w.writerow([m, f"{kg:.3f}", f"{fa:.6f}", n])
+            self._write_csv(path, self._material_sheet())
             messagebox.showinfo("Esportato", f"File salvato in:\n{path}")
         except Exception as e:
             messagebox.showerror("Errore", str(e))
@@ -1151,25 +1212,194 @@ class TankAnalysisApp(tk.Tk):
             return
         
         try:
+            # Scrittura diretta delle righe (stesso output di csv.writer): solo il
+            # Materiale può contenere separatori, quindi si quota solo quello
+            _, dt_strs, tanks, mats, gs, vs, fas, kgs = zip(*self._cache_debug)
+            quoted = {
+                m: '"' + m.replace('"', '""') + '"' if any(ch in m for ch in ',"\r\n') else m
+                for m in set(mats)
+            }
+            cols = zip(
+                dt_strs, tanks, [quoted[m] for m in mats],
+                format_column(gs, 2), format_column(vs, 2),
+                format_column(fas, 6), format_column(kgs, 3)
+            )
             with open(path, 'w', encoding='utf-8', newline='') as f:
-                w = csv.writer(f)
-                w.writerow(['Timestamp','Tank','Materiale','Gravity','Level_hl','f(A)','Kg_estratto'])
-                for dt, tank, mat, g, v, fa, kg in self._cache_debug:
-                    w.writerow([
-                        dt.strftime("%Y-%m-%d %H:%M:%S") if dt else "",
-                        tank, mat,
-                        f"{g:.2f}" if g is not None else "",
-                        f"{v:.2f}" if v is not None else "",
-                        f"{fa:.6f}" if fa is not None else "",
-                        f"{kg:.3f}"
-                    ])
+                f.write("Timestamp,Tank,Materiale,Gravity,Level_hl,f(A),Kg_estratto\r\n")
+                f.writelines(",".join(r) + "\r\n" for r in cols)
             messagebox.showinfo("Esportato", f"File salvato in:\n{path}")
         except Exception as e:
             messagebox.showerror("Errore", str(e))
     
+    def on_export_debug_xlsx(self):
+        """Esporta debug XLSX (scrittura XML diretta, senza openpyxl)"""
+        if not self._cache_debug:
+            return
+        
+        path = filedialog.asksaveasfilename(
+            title="Salva XLSX Debug",
+            defaultextension=".xlsx",
+            initialfile=EXPORT_FILENAMES['debug_xlsx'],
+            filetypes=[("Excel", "*.xlsx"), ("Tutti i file", "*.*")]
+        )
+        if not path:
+            return
+        
+        try:
+            self._write_debug_xlsx_direct(path, self._cache_debug)
+            messagebox.showinfo("Esportato", f"File salvato in:\n{path}\n\nRighe: {len(self._cache_debug)}")
+        except Exception as e:
+            messagebox.showerror("Errore", str(e))
+    
+    def _write_csv(self, path, sheet):
+        """
+        Scrive un foglio (titolo, intestazione, colonne) come CSV: ogni colonna numerica
+        è formattata con i suoi decimali in un'unica chiamata NumPy, poi csv.writer
+        scrive tutte le righe in blocco
+        """
+        _, header, columns = sheet
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            w = csv.writer(f)
+            w.writerow(header)
+            w.writerows(zip(*[format_column(values, nd) if nd else values
+                              for values, nd in columns]))
+    
+    def _material_sheet(self):
+        """Foglio Per Materiale come (titolo, intestazione, colonne), vedi _debug_sheet"""
+        mats = kgs = fas = counts = ()
+        if self._cache_mat:
+            mats, kgs, fas, counts = zip(*self._cache_mat)
+        return ('Per Materiale', ['Materiale','Kg_estratto','Somma_f(A)','Misure'],
+                [(mats, None), (kgs, 3), (fas, 6), (counts, 0)])
+    
+    def _tank_sheet(self):
+        """Foglio Per Tank come (titolo, intestazione, colonne), vedi _debug_sheet"""
+        tanks = mats = g_last = v_last = sum_fa = kg_ext = counts = ()
+        if self._cache_tank:
+            tanks, mats, g_last, v_last, sum_fa, kg_ext, counts = zip(*self._cache_tank)
+            mats = [mat or '' for mat in mats]
+        return ('Per Tank', ['Tank','Materiale','Gravity_ultimo','Volume_ultimo','Somma_f(A)','Kg_estratto','Misure'],
+                [(tanks, None), (mats, None), (g_last, 2), (v_last, 2), (sum_fa, 6), (kg_ext, 3), (counts, 0)])
+    
+    def _variations_sheet(self, variations):
+        """Foglio Variazioni come (titolo, intestazione, colonne), vedi _debug_sheet"""
+        (days, tanks, mats, v_prev, v_curr, delta_level,
+         g_prev, g_curr, kg_prev, kg_curr, delta_kg) = zip(*variations) if variations else ((),) * 11
+        return ('Variazioni', self._VARIATION_HEADER,
+                [(days, None), (tanks, None), (mats, None),
+                 (v_prev, 2), (v_curr, 2), (delta_level, 2), (g_prev, 2), (g_curr, 2),
+                 (kg_prev, 3), (kg_curr, 3), (delta_kg, 3)])
+    
+    def _debug_sheet(self, rows):
+        """
+        Foglio Debug come (titolo, intestazione, colonne); ogni colonna è (valori, decimali)
+        con decimali None per le colonne di testo e 0 per gli interi
+        """
+        if rows:
+            _, times, tanks, mats, gs, vs, fas, kgs = zip(*rows)
+        else:
+            times = tanks = mats = gs = vs = fas = kgs = ()
+        return ('Debug', ['Timestamp','Tank','Materiale','Gravity','Level_hl','f(A)','Kg_estratto'],
+                [(times, None), (tanks, None), (mats, None),
+                 (gs, 2), (vs, 2), (fas, 6), (kgs, 3)])
+    
+    def _write_debug_xlsx_direct(self, path, rows):
+        """Scrive il solo foglio Debug con lo scrittore XLSX diretto"""
+        self._write_xlsx_direct(path, [self._debug_sheet(rows)])
+    
+    def _write_xlsx_direct(self, path, sheets):
+        """
+        Scrive i fogli emettendo direttamente l'XML dello SpreadsheetML in uno zip
+        (nessun oggetto cella per valore: adatto a dump da 100k+ righe, non richiede openpyxl).
+        sheets: lista di (titolo, intestazione, colonne) come in _debug_sheet
+        """
+        ns_main = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+        ns_rel = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+        ns_pkg = "http://schemas.openxmlformats.org/package/2006/relationships"
+        head = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        ids = range(1, len(sheets) + 1)
+        
+        parts = {
+            '[Content_Types].xml': (
+                f'{head}<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+                '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+                '<Default Extension="xml" ContentType="application/xml"/>'
+                '<Override PartName="/xl/workbook.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+                + ''.join(
+                    f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                    for i in ids
+                ) +
+                '</Types>'
+            ),
+            '_rels/.rels': (
+                f'{head}<Relationships xmlns="{ns_pkg}">'
+                f'<Relationship Id="rId1" Type="{ns_rel}/officeDocument" Target="xl/workbook.xml"/>'
+                '</Relationships>'
+            ),
+            'xl/workbook.xml': (
+                f'{head}<workbook xmlns="{ns_main}" xmlns:r="{ns_rel}"><sheets>'
+                + ''.join(
+                    f'<sheet name="{escape(title)}" sheetId="{i}" r:id="rId{i}"/>'
+                    for i, (title, _, _) in zip(ids, sheets)
+                ) +
+                '</sheets></workbook>'
+            ),
+            'xl/_rels/workbook.xml.rels': (
+                f'{head}<Relationships xmlns="{ns_pkg}">'
+                + ''.join(
+                    f'<Relationship Id="rId{i}" Type="{ns_rel}/worksheet" Target="worksheets/sheet{i}.xml"/>'
+                    for i in ids
+                ) +
+                '</Relationships>'
+            ),
+        }
+        
+        def num_cells(values, nd):
+            # Valori mancanti o non finiti -> cella vuota
+            return ['' if v in ('', 'inf', '-inf') else f'<v>{v}</v>' for v in format_column(values, nd)]
+        
+        def text_cells(values):
+            # Stringa vuota -> cella vuota
+            return [f' t="inlineStr"><is><t>{escape(v)}</t></is>' if v else '>' for v in values]
+        
+        block_rows = 10000  # righe formattate e scritte per volta
+        
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+            for name, xml in parts.items():
+                zf.writestr(name, xml)
+            
+            for i, (title, header, columns) in zip(ids, sheets):
+                # Template riga precompilato: stringhe inline per il testo, <v> per i numeri
+                row_tpl = '<row r="{0}">' + ''.join(
+                    f'<c r="{chr(65 + j)}{{0}}"{{{j + 1}}}</c>' if nd is None
+                    else f'<c r="{chr(65 + j)}{{0}}">{{{j + 1}}}</c>'
+                    for j, (_, nd) in enumerate(columns)
+                ) + '</row>'
+                header_xml = '<row r="1">' + ''.join(
+                    f'<c t="inlineStr"><is><t>{escape(h)}</t></is></c>' for h in header
+                ) + '</row>'
+                
+                with zf.open(f'xl/worksheets/sheet{i}.xml', 'w') as fh:
+                    fh.write(f'{head}<worksheet xmlns="{ns_main}"><sheetData>{header_xml}'.encode('utf-8'))
+                    # Celle formattate e scritte a blocchi di righe: in memoria resta
+                    # solo l'XML del blocco corrente, non quello dell'intero foglio
+                    n_rows = len(columns[0][0]) if columns else 0
+                    for start in range(0, n_rows, block_rows):
+                        stop = start + block_rows
+                        cols = zip(*[text_cells(values[start:stop]) if nd is None
+                                     else num_cells(values[start:stop], nd)
+                                     for values, nd in columns])
+                        fh.write(''.join(
+                            row_tpl.format(r, *cells) for r, cells in enumerate(cols, start=start + 2)
+                        ).encode('utf-8'))
+                    fh.write(b'</sheetData></worksheet>')
+    
     def on_export_variations_csv(self):
         """Esporta variazioni CSV"""
-        if not hasattr(self, '_cache_variations') or not self._cache_variations:
+        variations = self._compute_variations()[0] if self._variations_key is not None else []
+        if not variations:
             messagebox.showwarning("Attenzione", "Carica prima le variazioni cliccando 'Carica Variazioni'")
             return
         
@@ -1183,25 +1413,8 @@ class TankAnalysisApp(tk.Tk):
             return
         
         try:
-            with open(path, 'w', encoding='utf-8', newline='') as f:
-                w = csv.writer(f)
-                w.writerow(['Data','Tank','Materiale','Level_Prec_hl','Level_Corr_hl','Delta_Level_hl',
-                           'Gravity_Prec','Gravity_Corr','Kg_Prec','Kg_Corr','Delta_Kg'])
-                
-                for var in self._cache_variations:
-                    curr_day, tank, mat_curr, v_prev, v_curr, delta_level, g_prev, g_curr, kg_prev, kg_curr, delta_kg = var
-                    
-                    w.writerow([
-                        curr_day, tank, mat_curr,
-                        f"{v_prev:.2f}" if v_prev is not None else "",
-                        f"{v_curr:.2f}" if v_curr is not None else "",
-                        f"{delta_level:.2f}" if delta_level is not None else "",
-                        f"{g_prev:.2f}" if g_prev is not None else "",
-                        f"{g_curr:.2f}" if g_curr is not None else "",
-                        f"{kg_prev:.3f}", f"{kg_curr:.3f}", f"{delta_kg:.3f}"
-                    ])
-            
-            messagebox.showinfo("Esportato", f"File salvato in:\n{path}\n\nVariazioni: {len(self._cache_variations)}")
+            self._write_csv(path, self._variations_sheet(variations))
+            messagebox.showinfo("Esportato", f"File salvato in:\n{path}\n\nVariazioni: {len(variations)}")
         except Exception as e:
             messagebox.showerror("Errore", str(e))
     
@@ -1229,12 +1442,42 @@ class TankAnalysisApp(tk.Tk):
         except Exception as e:
             messagebox.showerror("Errore", str(e))
     
+    def _report_sheets(self, excl_flag):
+        """Fogli del report XLSX come (titolo, intestazione, colonne), vedi _debug_sheet"""
+        excl = 'sì' if excl_flag else 'no'
+        notes = [
+            ('Equivalenza', "'Average Gravity' == 'Average Plato' (usati come 'Gravity')"),
+            ('f(A)', FA_FORMULA),
+            ('Kg estratto (riga)', 'f(A) * Level'),
+            ('Aggregazioni', 'Somme su periodo filtrato; Material per riga secondo colonna Material del tank'),
+            ('Mapping Material', '7=ichnusa; 8=non filtrata; 9=cruda; 28=ambra limpida'),
+            ('Totale Cantina', f"Material=0 escluso: {excl}"),
+            ('Modalità', 'Giorno singolo'),
+            ('', ''),
+            ('Tool Info', ''),
+            ('Sviluppato da', APP_AUTHOR),
+            ('Dipartimento', APP_DEPT),
+            ('Versione', APP_VERSION),
+            ('Contatto', APP_EMAIL),
+        ]
+        
+        sheets = [self._material_sheet(), self._tank_sheet(), self._debug_sheet(self._cache_debug)]
+        
+        # Variazioni, se caricate (riusa il calcolo già fatto per la tabella)
+        variations = self._compute_variations()[0] if self._variations_key is not None else []
+        if variations:
+            sheets.append(self._variations_sheet(variations))
+        
+        sheets.append(('Note', ['Descrizione','Valore'],
+                       [([d for d, _ in notes], None), ([v for _, v in notes], None)]))
+        return sheets
+    
     def on_export_xlsx(self):
         """Esporta report XLSX completo"""
         if not self._cache_mat and not self._cache_tank:
             return
-        if not HAS_OPENPYXL:
-            return
+        
+        excl_flag = self.var_exclude_mat0.get()
         
         path = filedialog.asksaveasfilename(
             title="Salva XLSX",
@@ -1246,58 +1489,20 @@ class TankAnalysisApp(tk.Tk):
             return
         
         try:
-            wb = Workbook()
-            
-            # Foglio 1: Per Materiale
-            ws1 = wb.active
-            ws1.title = 'Per Materiale'
-            ws1.append(['Materiale','Kg_estratto','Somma_f(A)','Misure'])
-            for m, kg, fa, n in self._cache_mat:
-                ws1.append([m, float(f"{kg:.3f}"), float(f"{fa:.6f}"), n])
-            
-            # Foglio 2: Per Tank
-            ws2 = wb.create_sheet('Per Tank')
-            ws2.append(['Tank','Materiale','Gravity_ultimo','Volume_ultimo','Somma_f(A)','Kg_estratto','Misure'])
-            for tank, mat, g_last, v_last, sum_fa, kg_ext, n in self._cache_tank:
-                ws2.append([
-                    tank, mat or '',
-                    float(f"{g_last:.2f}") if g_last is not None else None,
-                    float(f"{v_last:.2f}") if v_last is not None else None,
-                    float(f"{sum_fa:.6f}"), float(f"{kg_ext:.3f}"), n
-                ])
-            
-            # Foglio 3: Debug
-            ws3 = wb.create_sheet('Debug')
-            ws3.append(['Timestamp','Tank','Materiale','Gravity','Level_hl','f(A)','Kg_estratto'])
-            for dt, tank, mat, g, v, fa, kg in self._cache_debug:
-                ws3.append([
-                    dt.strftime("%Y-%m-%d %H:%M:%S") if dt else "",
-                    tank, mat,
-                    float(f"{g:.2f}") if g is not None else None,
-                    float(f"{v:.2f}") if v is not None else None,
-                    float(f"{fa:.6f}") if fa is not None else None,
-                    float(f"{kg:.3f}")
-                ])
-            
-            # Foglio 4: Note
-            ws4 = wb.create_sheet('Note')
-            ws4.append(['Descrizione','Valore'])
-            ws4.append(['Equivalenza', "'Average Gravity' == 'Average Plato' (usati come 'Gravity')"])
-            ws4.append(['f(A)', FA_FORMULA])
-            ws4.append(['Kg estratto (riga)', 'f(A) * Level'])
-            ws4.append(['Aggregazioni', 'Somme su periodo filtrato; Material per riga secondo colonna Material del tank'])
-            ws4.append(['Mapping Material', '7=ichnusa; 8=non filtrata; 9=cruda; 28=ambra limpida'])
-            excl = 'sì' if self.var_exclude_mat0.get() else 'no'
-            ws4.append(['Totale Cantina', f"Material=0 escluso: {excl}"])
-            ws4.append(['Modalità', 'Giorno singolo'])
-            ws4.append(['', ''])
-            ws4.append(['Tool Info', ''])
-            ws4.append(['Sviluppato da', APP_AUTHOR])
-            ws4.append(['Dipartimento', APP_DEPT])
-            ws4.append(['Versione', APP_VERSION])
-            ws4.append(['Contatto', APP_EMAIL])
-            
-            wb.save(path)
+            sheets = self._report_sheets(excl_flag)
+            if HAS_OPENPYXL:
+                # Modalità write-only: le righe sono scritte in streaming, senza griglia di celle in memoria
+                wb = Workbook(write_only=True)
+                for title, header, columns in sheets:
+                    ws = wb.create_sheet(title)
+                    ws.append(header)
+                    for row in zip(*[round_column(values, nd) if nd else values
+                                     for values, nd in columns]):
+                        ws.append(row)
+                wb.save(path)
+            else:
+                # Senza openpyxl: scrittura XML diretta
+                self._write_xlsx_direct(path, sheets)
             messagebox.showinfo("Esportato", f"File salvato in:\n{path}")
         except Exception as e:
             messagebox.showerror("Errore", str(e))
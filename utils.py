@@ -4,8 +4,12 @@
 Utilità, formattazione e calcoli per Tank Analysis Tool
 """
 
-import math
+import re
 from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+
 from config import FA_COEFFICIENTS, DATE_FORMATS, MATERIAL_MAPPING, MATERIAL_DEFAULT_EMPTY
 
 
@@ -18,23 +22,75 @@ def to_float(s):
     s = str(s).strip()
     if not s:
         return None
-    # Gestione formato europeo (1.234,56)
-    if "," in s and "." in s:
-        s = s.replace(".", "").replace(",", ".")
-    elif "," in s:
-        s = s.replace(",", ".")
+    # Gestione formato europeo (1.234,56): senza virgola nessuna sostituzione
+    if "," in s:
+        if "." in s:
+            s = s.replace(".", "").replace(",", ".")
+        else:
+            s = s.replace(",", ".")
     try:
         return float(s)
     except Exception:
         return None
 
 
+# Scambio separatori migliaia/decimali (stile inglese -> italiano) in un solo passaggio
+_IT_SEPARATORS = str.maketrans({",": ".", ".": ","})
+
+
+@lru_cache(maxsize=None)
+def _it_formatter(nd):
+    """Formatter "{:,.{nd}f}" già compilato per nd decimali"""
+    return f"{{:,.{nd}f}}".format
+
+
 def fmt_it(x, nd=2):
     """Formatta un numero in stile italiano (1.234,56)"""
     if x is None:
         return ""
-    s = f"{x:,.{nd}f}"
-    return s.replace(",", "X").replace(".", ",").replace("X", ".")
+    return _it_formatter(nd)(x).translate(_IT_SEPARATORS)
+
+
+def fmt_it_column(values, nd=2):
+    """
+    Formatta un'intera colonna in stile italiano (stesso output di fmt_it):
+    un solo formatter e un solo scambio dei separatori sul testo unito della colonna
+    """
+    if not values:
+        return []
+    fmt = _it_formatter(nd)
+    return "\n".join("" if x is None else fmt(x) for x in values).translate(_IT_SEPARATORS).split("\n")
+
+
+def _column_array(values):
+    """
+    Converte una colonna in array float64 usando NaN come unico sentinella:
+    None (e NaN) -> valore mancante. Restituisce (array, maschera mancanti).
+    """
+    arr = np.array(values, dtype=float)
+    return arr, np.isnan(arr)
+
+
+def format_column(values, nd=2):
+    """
+    Formatta un'intera colonna di numeri con nd decimali (stesso output di f"{x:.{nd}f}")
+    in un'unica chiamata NumPy. I valori mancanti diventano stringa vuota.
+    """
+    arr, missing = _column_array(values)
+    out = np.char.mod(f"%.{nd}f", arr)
+    out[missing] = ""
+    return out.tolist()
+
+
+def round_column(values, nd=2):
+    """
+    Arrotonda un'intera colonna a nd decimali (stesso valore di float(f"{x:.{nd}f}"))
+    in un'unica chiamata NumPy. I valori mancanti diventano None.
+    """
+    arr, missing = _column_array(values)
+    out = np.char.mod(f"%.{nd}f", arr).astype(float).astype(object)
+    out[missing] = None
+    return out.tolist()
 
 
 def parse_time(s):
@@ -55,49 +111,50 @@ def parse_time(s):
         return None
 
 
-# ============= CALCOLI =============
-
-def calculate_fA(gravity):
+def parse_time_column(values):
     """
-    Calcola f(A) dalla gravity usando la formula:
-    f(A) = ((a*G + b)*G + c)*G + d
+    Parsa un'intera colonna di date/ora in un array datetime64[s] (NaT se non valida).
+    Percorso veloce: se tutte le stringhe sono ISO "YYYY-MM-DD HH:MM:SS" le converte
+    NumPy in un'unica chiamata; altrimenti ripiega su parse_time per ogni stringa distinta.
     """
-    if gravity is None:
-        return None
-    
-    coef = FA_COEFFICIENTS
-    result = ((coef['a'] * gravity + coef['b']) * gravity + coef['c']) * gravity + coef['d']
-    return result
+    col = [v.strip() if v else "" for v in values]
+    if all(len(s) == 19 or not s for s in col):
+        try:
+            return np.array(col, dtype="datetime64[s]")
+        except ValueError:
+            pass
 
+    parsed = {}
+    for s in set(col):
+        dt = parse_time(s)
+        parsed[s] = np.datetime64(dt, "s") if dt else np.datetime64("NaT", "s")
+    return np.array([parsed[s] for s in col], dtype="datetime64[s]")
 
-def calculate_kg_extracted(gravity, level):
-    """
-    Calcola i Kg estratti:
-    Kg = f(A) × Level
-    """
-    if gravity is None or level is None:
-        return None
-    
-    fa_value = calculate_fA(gravity)
-    if fa_value is None:
-        return None
-    
-    # Gestione valori negativi o NaN
-    if isinstance(level, float) and math.isnan(level):
-        level = 0.0
-    if level < 0:
-        level = 0.0
-    
-    return fa_value * level
 
+# ============= CALCOLI =============
+
+# Coefficienti di f(A) letti una sola volta all'import
+_FA_A = FA_COEFFICIENTS['a']
+_FA_B = FA_COEFFICIENTS['b']
+_FA_C = FA_COEFFICIENTS['c']
+_FA_D = FA_COEFFICIENTS['d']
 
-def is_valid_value(value):
-    """Verifica se un valore è valido (non None, non NaN)"""
-    if value is None:
-        return False
-    if isinstance(value, float) and math.isnan(value):
-        return False
-    return True
+
+def calculate_kg_extracted_array(gravity, level):
+    """
+    Calcola f(A) = ((a*G + b)*G + c)*G + d e i Kg estratti (Kg = f(A) × Level)
+    su array NumPy di gravity e Level (gravity NaN -> f(A) e Kg NaN). Level deve
+    essere già sanificato con sanitize_level_array: qui non si ripete la passata
+    su NaN e negativi
+    
+    Returns:
+        tuple: (kg, fa)
+    """
+    G = np.asarray(gravity, dtype=np.float64)
+    V = np.asarray(level, dtype=np.float64)
+    fa = ((_FA_A * G + _FA_B) * G + _FA_C) * G + _FA_D
+    with np.errstate(invalid='ignore'):
+        return fa * V, fa
 
 
 # ============= NORMALIZZAZIONE MATERIALI =============
@@ -113,6 +170,17 @@ def normalize_material(val):
         return MATERIAL_DEFAULT_EMPTY
     
     s = str(val).strip()
+    
+    # Percorso veloce: codici e materiali noti già normalizzati
+    label = _MATERIAL_LUT.get(s)
+    if label is not None:
+        return label
+    
+    return _classify_material(s)
+
+
+def _classify_material(s):
+    """Normalizza una stringa materiale già ripulita dagli spazi (percorso completo)"""
     if not s:
         return MATERIAL_DEFAULT_EMPTY
     
@@ -130,45 +198,51 @@ def normalize_material(val):
         pass
     
     # 3. Prova come testo (normalizza accentazione)
-    low = s.lower().strip()
-    low = _remove_accents(low)
+    low = s.strip().lower().translate(_ACCENT_TABLE)
     
-    # Pattern matching per testi
-    if 'ichnusa' in low:
-        return 'ichnusa'
-    if 'non filtrata' in low or 'nonfiltrata' in low:
-        return 'non filtrata'
-    if 'cruda' in low:
-        return 'cruda'
-    if 'ambra' in low and 'limpida' in low:
-        return 'ambra limpida'
+    # Pattern matching per testi (un'unica regex, stessa priorità dei pattern)
+    m = _MAT_RE.match(low)
+    if m:
+        return _MAT_LABELS[m.lastindex - 1]
     
     return s
 
 
-def _remove_accents(text):
-    """Rimuove accenti dalle lettere"""
-    accent_map = {
-        'ì': 'i', 'í': 'i', 'ï': 'i', 'î': 'i',
-        'à': 'a', 'á': 'a', 'ä': 'a', 'â': 'a',
-        'è': 'e', 'é': 'e', 'ë': 'e', 'ê': 'e',
-        'ò': 'o', 'ó': 'o', 'ö': 'o', 'ô': 'o',
-        'ù': 'u', 'ú': 'u', 'ü': 'u', 'û': 'u',
-    }
-    return ''.join(accent_map.get(ch, ch) for ch in text)
+# Tabella di traduzione precalcolata per rimuovere gli accenti
+_ACCENT_TABLE = str.maketrans({
+    'ì': 'i', 'í': 'i', 'ï': 'i', 'î': 'i',
+    'à': 'a', 'á': 'a', 'ä': 'a', 'â': 'a',
+    'è': 'e', 'é': 'e', 'ë': 'e', 'ê': 'e',
+    'ò': 'o', 'ó': 'o', 'ö': 'o', 'ô': 'o',
+    'ù': 'u', 'ú': 'u', 'ü': 'u', 'û': 'u',
+})
+
+
+# Pattern dei materiali testuali in ordine di priorità: le alternative (lookahead dall'inizio)
+# sono provate in ordine, il gruppo catturato (lastindex) indica il materiale
+_MAT_RE = re.compile(
+    r"(?=.*(ichnusa))|(?=.*(non ?filtrata))|(?=.*(cruda))|(?=.*ambra)(?=.*(limpida))",
+    re.S
+)
+_MAT_LABELS = ('ichnusa', 'non filtrata', 'cruda', 'ambra limpida')
+
+
+# Tabella precalcolata col percorso completo: codici, materiali e loro forme minuscole
+_MATERIAL_LUT = {
+    key: _classify_material(key)
+    for key in ['', *MATERIAL_MAPPING, *MATERIAL_MAPPING.values(),
+                *(label.lower() for label in MATERIAL_MAPPING.values())]
+}
 
 
 # ============= VALIDAZIONE DATI =============
 
-def sanitize_level(level):
+def sanitize_level_array(level):
     """
-    Sanifica il valore di Level:
-    - None o NaN → 0.0
+    Sanifica un array NumPy di Level in un'unica passata:
+    - NaN (valore mancante) → 0.0
     - Negativo → 0.0
     - Altrimenti mantiene il valore
     """
-    if level is None or (isinstance(level, float) and math.isnan(level)):
-        return 0.0
-    if level < 0:
-        return 0.0
-    return level
\ No newline at end of file
+    V = np.asarray(level, dtype=np.float64)
+    return np.clip(np.nan_to_num(V, nan=0.0, posinf=np.inf, neginf=-np.inf), 0.0, None)